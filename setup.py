@@ -35,6 +35,7 @@ setup(name='dbmap',
           'networkx>=2.1',
           'scikit-learn',
           'joblib',
+          'numba',
           'umap-learn',
           'fcsparser>=0.1.2',
           'tables>=3.4.2',
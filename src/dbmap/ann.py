@@ -13,6 +13,7 @@ from sklearn.base import TransformerMixin, BaseEstimator
 from scipy.sparse import csr_matrix, find, issparse
 from sklearn.neighbors import NearestNeighbors
 from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import normalize
 
 try:
     import nmslib
@@ -22,6 +23,37 @@ except ImportError:
 
 print(__doc__)
 
+# nmslib spaces corresponding to each accepted metric, for sparse and dense input.
+_NMSLIB_SPARSE_SPACES = {
+    'sqeuclidean': 'l2_sparse',
+    'euclidean': 'l2_sparse',
+    'cosine': 'cosinesimil_sparse_fast',
+    'lp': 'lp_sparse',
+    'l1': 'l1_sparse',
+    'l1_sparse': 'l1_sparse',
+    'linf': 'linf_sparse',
+    'linf_sparse': 'linf_sparse',
+    'angular': 'angulardist_sparse_fast',
+    'angular_sparse': 'angulardist_sparse_fast',
+    'negdotprod': 'negdotprod_sparse_fast',
+    'negdotprod_sparse': 'negdotprod_sparse_fast',
+}
+
+_NMSLIB_DENSE_SPACES = {
+    'sqeuclidean': 'l2',
+    'euclidean': 'l2',
+    'cosine': 'cosinesimil',
+    'lp': 'lp',
+    'l1': 'l1',
+    'linf': 'linf',
+    'angular': 'angulardist',
+    'negdotprod': 'negdotprod',
+    'levenshtein': 'leven',
+    'hamming': 'bit_hamming',
+    'jaccard': 'bit_jaccard',
+    'jansen-shan': 'jsmetrfastapprox'
+}
+
 
 class NMSlibTransformer(TransformerMixin, BaseEstimator):
     """
@@ -139,12 +171,7 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
         # see more metrics in the manual
         # https://github.com/nmslib/nmslib/tree/master/manual
 
-        if self.dense:
-            self.nmslib_ = nmslib.init(method=self.method,
-                                       space=self.space,
-                                       data_type=nmslib.DataType.DENSE_VECTOR)
-
-        else:
+        if not self.dense:
             if issparse(data) == True:
                 if self.verbose:
                     print('Sparse input. Proceding without converting...')
@@ -159,18 +186,16 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
 
         index_time_params = {'M': self.M, 'indexThreadQty': self.n_jobs, 'efConstruction': self.efC, 'post': 2}
 
+        self._prenormalized = False
         if issparse(data) and (not self.dense) and (not isinstance(data, np.ndarray)):
             if self.metric not in ['levenshtein', 'hamming', 'jansen-shan', 'jaccard']:
-                self.space = {
-                    'sqeuclidean': 'l2_sparse',
-                    'euclidean': 'l2_sparse',
-                    'cosine': 'cosinesimil_sparse_fast',
-                    'lp': 'lp_sparse',
-                    'l1_sparse': 'l1_sparse',
-                    'linf_sparse': 'linf_sparse',
-                    'angular_sparse': 'angulardist_sparse_fast',
-                    'negdotprod_sparse': 'negdotprod_sparse_fast',
-                }[self.metric]
+                self.space = _NMSLIB_SPARSE_SPACES[self.metric]
+                if self.metric in ['cosine', 'angular', 'angular_sparse']:
+                    # L2-normalize the rows once, so that cosine and angular distances reduce to a
+                    # plain dot product and nmslib does not renormalize every pair of vectors.
+                    data = normalize(data, norm='l2')
+                    self.space = 'negdotprod_sparse_fast'
+                    self._prenormalized = True
                 if self.metric == 'lp':
                     self.nmslib_ = nmslib.init(method=self.method,
                                                space=self.space,
@@ -183,24 +208,12 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
             else:
                 print('Metric ' + self.metric + 'available for string data only. Trying to compute distances...')
                 data = data.toarray()
+                self.space = _NMSLIB_DENSE_SPACES[self.metric]
                 self.nmslib_ = nmslib.init(method=self.method,
                                            space=self.space,
                                            data_type=nmslib.DataType.OBJECT_AS_STRING)
         else:
-            self.space = {
-                'sqeuclidean': 'l2',
-                'euclidean': 'l2',
-                'cosine': 'cosinesimil',
-                'lp': 'lp',
-                'l1': 'l1',
-                'linf': 'linf',
-                'angular': 'angulardist',
-                'negdotprod': 'negdotprod',
-                'levenshtein': 'leven',
-                'hamming': 'bit_hamming',
-                'jaccard': 'bit_jaccard',
-                'jansen-shan': 'jsmetrfastapprox'
-            }[self.metric]
+            self.space = _NMSLIB_DENSE_SPACES[self.metric]
             if self.metric == 'lp':
                 self.nmslib_ = nmslib.init(method=self.method,
                                            space=self.space,
@@ -223,6 +236,20 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
 
         return self
 
+    def _normalize_query(self, data):
+        """L2-normalizes query rows when the index was built on pre-normalized data."""
+        if self._prenormalized:
+            return normalize(data, norm='l2')
+        return data
+
+    def _from_negdotprod(self, distances):
+        """Converts, in place, negative dot products of normalized rows to the requested metric."""
+        if self.metric == 'cosine':
+            distances += 1
+            np.maximum(distances, 0, out=distances)
+        else:
+            np.arccos(np.clip(-distances, -1, 1), out=distances)
+
     def transform(self, data):
         start = time.time()
         n_samples_transform = data.shape[0]
@@ -230,24 +257,29 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
         if self.verbose:
             print('Query-time parameter efSearch:', self.efS)
         self.nmslib_.setQueryTimeParams(query_time_params)
+        data = self._normalize_query(data)
 
         # For compatibility reasons, as each sample is considered as its own
         # neighbor, one extra neighbor will be computed.
-        self.n_neighbors = self.n_neighbors + 1
+        k = self.n_neighbors + 1
 
-        results = self.nmslib_.knnQueryBatch(data, k=self.n_neighbors,
+        results = self.nmslib_.knnQueryBatch(data, k=k,
                                              num_threads=self.n_jobs)
 
-        indices, distances = zip(*results)
-        indices, distances = np.vstack(indices), np.vstack(distances)
+        indices = np.empty((n_samples_transform, k), dtype=np.int32)
+        distances = np.empty((n_samples_transform, k), dtype=np.float32)
+        for i, (ind, dist) in enumerate(results):
+            indices[i] = ind
+            distances[i] = dist
 
         query_qty = data.shape[0]
 
         if self.metric == 'sqeuclidean':
             distances **= 2
+        if self._prenormalized:
+            self._from_negdotprod(distances)
 
-        indptr = np.arange(0, n_samples_transform * self.n_neighbors + 1,
-                           self.n_neighbors)
+        indptr = np.arange(0, n_samples_transform * k + 1, k)
         kneighbors_graph = csr_matrix((distances.ravel(), indices.ravel(),
                                        indptr), shape=(n_samples_transform,
                                                        n_samples_transform))
@@ -266,21 +298,26 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
         if self.verbose:
             print('Query-time parameter efSearch:', self.efS)
         self.nmslib_.setQueryTimeParams(query_time_params)
+        data = self._normalize_query(data)
         # For compatibility reasons, as each sample is considered as its own
         # neighbor, one extra neighbor will be computed.
-        self.n_neighbors = self.n_neighbors + 1
-        results = self.nmslib_.knnQueryBatch(data, k=self.n_neighbors,
+        k = self.n_neighbors + 1
+        results = self.nmslib_.knnQueryBatch(data, k=k,
                                              num_threads=self.n_jobs)
-        indices, distances = zip(*results)
-        indices, distances = np.vstack(indices), np.vstack(distances)
+        indices = np.empty((n_samples_transform, k), dtype=np.int32)
+        distances = np.empty((n_samples_transform, k), dtype=np.float32)
+        for i, (ind, dist) in enumerate(results):
+            indices[i] = ind
+            distances[i] = dist
 
         query_qty = data.shape[0]
 
         if self.metric == 'sqeuclidean':
             distances **= 2
+        if self._prenormalized:
+            self._from_negdotprod(distances)
 
-        indptr = np.arange(0, n_samples_transform * self.n_neighbors + 1,
-                           self.n_neighbors)
+        indptr = np.arange(0, n_samples_transform * k + 1, k)
         kneighbors_graph = csr_matrix((distances.ravel(), indices.ravel(),
                                        indptr), shape=(n_samples_transform,
                                                        n_samples_transform))
@@ -349,12 +386,13 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
         if self.verbose:
             print('Setting query-time parameters', query_time_params)
         self.nmslib_.setQueryTimeParams(query_time_params)
+        data = self._normalize_query(data)
 
         # For compatibility reasons, as each sample is considered as its own
         # neighbor, one extra neighbor will be computed.
-        self.n_neighbors = self.n_neighbors + 1
+        k = self.n_neighbors + 1
         start = time.time()
-        ann_results = self.nmslib_.knnQueryBatch(data, k=self.n_neighbors,
+        ann_results = self.nmslib_.knnQueryBatch(data, k=k,
                                                  num_threads=self.n_jobs)
         end = time.time()
         if self.verbose:
@@ -363,7 +401,7 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
 
         # Use sklearn for exact neighbor search
         start = time.time()
-        nbrs = NearestNeighbors(n_neighbors=self.n_neighbors,
+        nbrs = NearestNeighbors(n_neighbors=k,
                                 metric='cosine',
                                 algorithm='brute').fit(data)
         knn = nbrs.kneighbors(data)
@@ -372,12 +410,19 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
             print('brute-force gold-standart kNN time total=%f (sec), per query=%f (sec)' %
                   (end - start, float(end - start) / query_qty))
 
-        recall = 0.0
-        for i in range(0, query_qty):
-            correct_set = set(knn[1][i])
-            ret_set = set(ann_results[i][0])
-            recall = recall + float(len(correct_set.intersection(ret_set))) / len(correct_set)
-        recall = recall / query_qty
+        # nmslib may return fewer than k neighbors for some queries; missing ones are padded with -1
+        ann_indices = np.full((query_qty, k), -1, dtype=np.int64)
+        for i, (ind, dist) in enumerate(ann_results):
+            ann_indices[i, :len(ind)] = ind
+
+        # Look up every exact neighbor among the sorted approximate ones in a single search.
+        # Offsetting each row by a stride larger than any returned id (padding included) keeps rows apart.
+        stride = max(query_qty, ann_indices.max() + 1) + 1
+        offsets = np.arange(query_qty, dtype=np.int64)[:, None] * stride
+        ann_flat = np.sort(ann_indices + offsets, axis=1).ravel()
+        correct_flat = (knn[1] + offsets).ravel()
+        pos = np.minimum(np.searchsorted(ann_flat, correct_flat), ann_flat.size - 1)
+        recall = np.mean(ann_flat[pos] == correct_flat)
         print('kNN recall %f' % recall)
 
     def update_search(self, n_neighbors):
@@ -4,12 +4,14 @@
 # contact: davisidarta@gmail.com
 # Please note that this code has several contributions from Manu Setty et al, Nature
 ######################################
+import math
 import time
+import numba
 import numpy as np
 import pandas as pd
 from scipy import stats
-from scipy.sparse import csr_matrix, find, issparse
-from scipy.sparse.linalg import eigs
+from scipy.sparse import coo_matrix, csr_matrix, issparse
+from scipy.sparse.linalg import eigsh, lobpcg
 from sklearn.base import TransformerMixin
 from sklearn.neighbors import NearestNeighbors
 from sklearn.preprocessing import normalize
@@ -19,6 +21,41 @@ from . import multiscale
 
 print(__doc__)
 
+# cuML names of the `ann_dist` metrics available with the 'cuml' backend.
+_CUML_METRICS = {
+    'sqeuclidean': 'sqeuclidean',
+    'euclidean': 'euclidean',
+    'cosine': 'cosine',
+    'lp': 'minkowski',
+    'l1': 'l1',
+    'linf': 'chebyshev',
+}
+
+
+@numba.njit(parallel=True, cache=True)
+def _row_kth_distance(data, indptr, kth):
+    """Distance to the kth[i]-th (0-based) nearest neighbor of each row of a CSR kNN graph."""
+    n = indptr.shape[0] - 1
+    out = np.empty(n, dtype=data.dtype)
+    for i in numba.prange(n):
+        out[i] = np.partition(data[indptr[i]:indptr[i + 1]], kth[i])[kth[i]]
+    return out
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _adaptive_affinities(dists, indptr, sd, expo):
+    """Affinities exp(-(d / sd[i]) ** expo[i]) of each row of a CSR kNN graph, computed in a single pass."""
+    n = indptr.shape[0] - 1
+    out = np.empty_like(dists)
+    for i in numba.prange(n):
+        scale = sd[i] + 1e-10
+        for j in range(indptr[i], indptr[i + 1]):
+            d = dists[j] / scale
+            if expo[i] != 1:
+                d = d ** expo[i]
+            out[j] = math.exp(-d)
+    return out
+
 
 class Diffusor(TransformerMixin):
     """
@@ -46,6 +83,15 @@ class Diffusor(TransformerMixin):
 
     verbose : controls verbosity.
 
+    backend : Library used for nearest-neighbors search when `ann` is True. Defaults to 'nmslib'. With 'cuml', dense
+              input is searched on the GPU with RAPIDS cuML for the 'sqeuclidean', 'euclidean', 'cosine', 'lp',
+              'l1' and 'linf' metrics. Sparse input, other metrics or a missing cuML installation fall back
+              to 'nmslib'.
+
+    eigen_solver : Eigensolver for the diffusion components, either 'arpack' or 'lobpcg'. Defaults to 'arpack'.
+                   Both return the components with the largest eigenvalues. 'lobpcg' is a fallback for when
+                   ARPACK does not converge.
+
 
     Returns
     -------------
@@ -86,7 +132,9 @@ class Diffusor(TransformerMixin):
                  transitions=True,
                  eigengap=True,
                  norm=False,
-                 verbose=True
+                 verbose=True,
+                 backend='nmslib',
+                 eigen_solver='arpack'
                  ):
         self.n_components = n_components
         self.n_neighbors = n_neighbors
@@ -104,6 +152,8 @@ class Diffusor(TransformerMixin):
         self.eigengap = eigengap
         self.norm = norm
         self.verbose = verbose
+        self.backend = backend
+        self.eigen_solver = eigen_solver
 
     def fit(self, data):
         """Fits an adaptive anisotropic kernel to the data.
@@ -119,7 +169,35 @@ class Diffusor(TransformerMixin):
                   'for similar results.')
         if self.kernel_use not in ['simple', 'simple_adaptive', 'decay', 'decay_adaptive']:
             raise Exception('Kernel must be either \'simple\', \'simple_adaptive\', \'decay\' or \'decay_adaptive\'.') 
-        if self.ann:
+        if self.backend not in ['nmslib', 'cuml']:
+            raise Exception('Backend must be either \'nmslib\' or \'cuml\'.')
+        if self.eigen_solver not in ['arpack', 'lobpcg']:
+            raise Exception('Eigensolver must be either \'arpack\' or \'lobpcg\'.')
+        use_cuml = self.ann and self.backend == 'cuml'
+        if use_cuml and issparse(data):
+            print('The \'cuml\' backend supports dense input only. Falling back to \'nmslib\'.')
+            use_cuml = False
+        if use_cuml and self.ann_dist not in _CUML_METRICS:
+            print('Metric \'' + self.ann_dist + '\' is not available with the \'cuml\' backend. '
+                  'Falling back to \'nmslib\'.')
+            use_cuml = False
+        if use_cuml:
+            try:
+                from cuml.neighbors import NearestNeighbors as cuNearestNeighbors
+            except ImportError:
+                print('Package \'cuml\' is not installed. Falling back to \'nmslib\'.')
+                use_cuml = False
+        if use_cuml:
+            # Construct the k-nearest-neighbors graph on the GPU. As with nmslib, each sample is
+            # returned as its own neighbor, so one extra neighbor is computed.
+            # cuML takes the Minkowski exponent as the `p` constructor argument
+            cuml_params = {'p': self.p} if self.ann_dist == 'lp' else {}
+            nbrs = cuNearestNeighbors(n_neighbors=self.n_neighbors + 1,
+                                      metric=_CUML_METRICS[self.ann_dist],
+                                      output_type='numpy',
+                                      **cuml_params).fit(data)
+            knn = nbrs.kneighbors_graph(data, mode='distance').tocsr()
+        elif self.ann:
             if self.ann_dist == 'lp' and self.p < 1:
                 print('Fractional L norms are slower to compute. Computations are faster for fractions'
                       ' of the form \'1/2ek\', where k is a small integer (i.g. 0.5, 0.25) ')
@@ -134,13 +212,6 @@ class Diffusor(TransformerMixin):
                                           efS=self.efS,
                                           verbose=self.verbose).fit(data)
             knn = anbrs.transform(data)
-            # X, y specific stds: Normalize by the distance of median nearest neighbor to account for neighborhood size.
-            median_k = np.floor(self.n_neighbors / 2).astype(np.int)
-            adap_sd = np.zeros(self.N)
-            for i in np.arange(len(adap_sd)):
-                adap_sd[i] = np.sort(knn.data[knn.indptr[i]: knn.indptr[i + 1]])[
-                    median_k - 1
-                    ]
         else:
             if self.ann_dist == 'lp':
                 raise Exception('Generalized Lp distances are available only with `ann` set to True.')
@@ -149,20 +220,20 @@ class Diffusor(TransformerMixin):
             nbrs = NearestNeighbors(n_neighbors=int(self.n_neighbors), metric=self.knn_dist, n_jobs=self.n_jobs).fit(
                 data)
             knn = nbrs.kneighbors_graph(data, mode='distance')
-            x, y, dist = find(knn)
-            # X, y specific stds: Normalize by the distance of median nearest neighbor to account for neighborhood size.
-            median_k = np.floor(self.n_neighbors / 2).astype(np.int)
-            adap_sd = np.zeros(self.N)
-            for i in np.arange(len(adap_sd)):
-                adap_sd[i] = np.sort(knn.data[knn.indptr[i]: knn.indptr[i + 1]])[
-                    median_k - 1
-                    ]
-
-        # Distance metrics
-        x, y, dists = find(knn)  # k-nearest-neighbor distances
+
+        # Distances and affinities are computed in single precision, as nmslib already returns float32 distances
+        knn.data = knn.data.astype(np.float32, copy=False)
+
+        # X, y specific stds: Normalize by the distance of median nearest neighbor to account for neighborhood size.
+        median_k = self.n_neighbors // 2
+        adap_sd = _row_kth_distance(knn.data, knn.indptr, np.full(self.N, median_k - 1))
+
+        # Distance metrics are read directly from the CSR arrays of the k-nearest-neighbor graph.
+        # Zero distances are dropped from the graph, as find() used to do.
+        knn.eliminate_zeros()
 
         # define decay as sample's pseudomedian k-nearest-neighbor
-        pm = np.interp(adap_sd, (adap_sd.min(), adap_sd.max()), (2, self.n_neighbors))
+        pm = np.interp(adap_sd, (adap_sd.min(), adap_sd.max()), (2, self.n_neighbors)).astype(np.float32)
 
         # adaptive neighborhood size
         if self.kernel_use == 'simple_adaptive' or self.kernel_use == 'decay_adaptive':
@@ -177,82 +248,116 @@ class Diffusor(TransformerMixin):
                                               efS=self.efS).fit(data)
             knn_new = anbrs_new.transform(data)
 
-            x_new, y_new, dists_new = find(knn_new)
-
             # adaptive neighborhood size
-            adap_nbr = np.zeros(self.N)
-            for i in np.arange(len(adap_nbr)):
-                adap_k = int(np.floor(pm[i]))
-                adap_nbr[i] = np.sort(knn_new.data[knn_new.indptr[i]: knn_new.indptr[i + 1]])[
-                    int(pm[i])
-                ]
+            adap_nbr = _row_kth_distance(knn_new.data, knn_new.indptr, pm.astype(np.int64))
+            knn_new.eliminate_zeros()
 
+        # Normalization, decay and exponentiation are fused in _adaptive_affinities, whose
+        # output is used as the data of W.
         if self.kernel_use == 'simple':
-            # X, y specific stds
-            dists = dists / (adap_sd[x] + 1e-10)  # Normalize by the distance of median nearest neighbor
-            W = csr_matrix((np.exp(-dists), (x, y)), shape=[self.N, self.N])  # Normalized distances
+            # X, y specific stds: Normalize by the distance of median nearest neighbor
+            affinities = _adaptive_affinities(knn.data, knn.indptr, adap_sd, np.ones(self.N, dtype=np.float32))
+            W = csr_matrix((affinities, knn.indices, knn.indptr), shape=[self.N, self.N])  # Normalized distances
 
         if self.kernel_use == 'simple_adaptive':
-            # X, y specific stds
-            dists = dists_new / (adap_nbr[x_new] + 1e-10)  # Normalize by normalized contribution to neighborhood size.
-            W = csr_matrix((np.exp(-dists), (x_new, y_new)), shape=[self.N, self.N])  # Normalized distances
+            # X, y specific stds: Normalize by normalized contribution to neighborhood size.
+            affinities = _adaptive_affinities(knn_new.data, knn_new.indptr, adap_nbr, np.ones(self.N, dtype=np.float32))
+            W = csr_matrix((affinities, knn_new.indices, knn_new.indptr), shape=[self.N, self.N])  # Normalized distances
 
         if self.kernel_use == 'decay':
             # X, y specific stds
-            dists = (dists / (adap_sd[x] + 1e-10)) ** np.power(2, ((self.n_neighbors - pm[x]) / pm[x]))
-            W = csr_matrix((np.exp(-dists), (x, y)), shape=[self.N, self.N])  # Normalized distances
+            decay = np.power(2, ((self.n_neighbors - pm) / pm))
+            affinities = _adaptive_affinities(knn.data, knn.indptr, adap_sd, decay)
+            W = csr_matrix((affinities, knn.indices, knn.indptr), shape=[self.N, self.N])  # Normalized distances
 
         if self.kernel_use == 'decay_adaptive':
-            # X, y specific stds
-            dists = (dists_new / (adap_nbr[x_new]+ 1e-10)) ** np.power(2, (((int(self.n_neighbors + (self.n_neighbors - pm.max()))) - pm[x_new]) / pm[x_new]))  # Normalize by normalized contribution to neighborhood size.
-            W = csr_matrix((np.exp(-dists), (x_new, y_new)), shape=[self.N, self.N])  # Normalized distances
-
-        # Kernel construction
-        kernel = W + W.T
+            # X, y specific stds: Normalize by normalized contribution to neighborhood size.
+            decay = np.power(2, (((int(self.n_neighbors + (self.n_neighbors - pm.max()))) - pm) / pm))
+            affinities = _adaptive_affinities(knn_new.data, knn_new.indptr, adap_nbr, decay)
+            W = csr_matrix((affinities, knn_new.indices, knn_new.indptr), shape=[self.N, self.N])  # Normalized distances
+
+        # Kernel construction: W and its transpose are stacked as COO triplets, and
+        # overlapping entries are summed during the conversion to CSR.
+        w_rows = np.repeat(np.arange(self.N, dtype=W.indices.dtype), np.diff(W.indptr))
+        kernel = coo_matrix((np.concatenate([W.data, W.data]),
+                             (np.concatenate([w_rows, W.indices]), np.concatenate([W.indices, w_rows]))),
+                            shape=[self.N, self.N]).tocsr()
+        # Affinities that underflowed to zero would otherwise be kept as stored entries
+        kernel.eliminate_zeros()
         self.K = kernel
 
         # handle nan, zeros
         self.K.data = np.where(np.isnan(self.K.data), 1, self.K.data)
+        # The Markov normalization and the diffusion operators are kept in double precision: in float32 the
+        # top eigenvalue of a stochastic operator rounds to 1 or just above it, which breaks multiscaling.
+        self.K.data = self.K.data.astype(np.float64)
         # Diffusion through Markov chain
 
         D = np.ravel(self.K.sum(axis=1))
+        # Row of each stored kernel entry. Diagonal scalings are applied directly to the
+        # CSR values instead of multiplying by diagonal matrices.
+        rows = np.repeat(np.arange(self.N, dtype=self.K.indices.dtype), np.diff(self.K.indptr))
         if self.alpha > 0:
             # L_alpha
             D[D != 0] = D[D != 0] ** (-self.alpha)
-            mat = csr_matrix((D, (range(self.N), range(self.N))), shape=[self.N, self.N])
-            kernel = mat.dot(self.K).dot(mat)
+            kernel = self.K.copy()
+            kernel.data *= D[rows] * D[kernel.indices]
             D = np.ravel(kernel.sum(axis=1))
 
         D[D != 0] = 1 / D[D != 0]
 
         # Setting the diffusion operator
         if not self.norm:
-            self.T = csr_matrix((D, (range(self.N), range(self.N))), shape=[self.N, self.N]).dot(self.K)
+            self.T = self.K.copy()
         else:
             self.K = kernel
-            self.T = csr_matrix((D, (range(self.N), range(self.N))), shape=[self.N, self.N]).dot(self.K)
+            self.T = self.K.copy()
+        self.T.data *= D[rows]
+
+        # T = D K is similar to the symmetric S = D^1/2 K D^1/2, which is decomposed instead
+        self.D_sqrt = np.sqrt(D)
+        self.S = self.K.copy()
+        self.S.data *= self.D_sqrt[rows] * self.D_sqrt[self.S.indices]
 
         return self
 
 
+    def _eigs(self, n_components):
+        """Eigendecomposition of the diffusion operator, or of the kernel if `transitions` is False.
+        Both are decomposed with a real symmetric solver: eigenvectors of T are recovered
+        from those of its symmetric conjugate S as D^1/2 U. Both solvers select the largest
+        algebraic eigenvalues. Components are returned sorted by decreasing eigenvalue and
+        normalized to unit norm.
+        """
+        op = self.S if self.transitions else self.K
+        # A fixed starting guess in the operator's precision makes the decomposition reproducible
+        random_state = np.random.RandomState(0)
+        if self.eigen_solver == 'lobpcg':
+            # The block is kept in double precision, as LOBPCG's Rayleigh-Ritz step is ill-conditioned in float32
+            X0, _ = np.linalg.qr(random_state.standard_normal((self.N, n_components)))
+            D, V = lobpcg(op, X0, tol=1e-4, maxiter=200, largest=True)
+        else:
+            v0 = random_state.standard_normal(self.N).astype(op.dtype)
+            ncv = min(self.N, max(2 * n_components + 1, 20))
+            D, V = eigsh(op, n_components, which='LA', ncv=ncv, tol=1e-4, maxiter=self.N, v0=v0)
+        if self.transitions:
+            V = self.D_sqrt[:, None] * V
+        # Sort components by decreasing eigenvalue and normalize each to unit norm
+        inds = np.argsort(D)[::-1]
+        D = D[inds]
+        V = V[:, inds]
+        norms = np.linalg.norm(V, axis=0)
+        norms[norms == 0] = 1
+        V /= norms
+        return D, V
+
     def transform(self, data):
 
         # Fit an optimal number of components based on the eigengap
         # Use user's  or default initial guess
         multiplier = self.N // 10e4
         # initial eigen value decomposition
-        if self.transitions:
-            D, V = eigs(self.T, self.n_components, tol=1e-4, maxiter=self.N)
-        else:
-            D, V = eigs(self.K, self.n_components, tol=1e-4, maxiter=self.N)
-        D = np.real(D)
-        V = np.real(V)
-        inds = np.argsort(D)[::-1]
-        D = D[inds]
-        V = V[:, inds]
-        # Normalize by the first diffusion component
-        for i in range(V.shape[1]):
-            V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
+        D, V = self._eigs(self.n_components)
         vals = np.array(V)
         pos = np.sum(vals > 0, axis=0)
         residual = np.sum(vals < 0, axis=0)
@@ -263,18 +368,7 @@ class Diffusor(TransformerMixin):
             while residual < 3:
                 print('Eigengap not found for determined number of components. Expanding eigendecomposition to '
                       + str(target) + 'components.')
-                if self.transitions:
-                    D, V = eigs(self.T, target, tol=1e-4, maxiter=self.N)
-                else:
-                    D, V = eigs(self.K, target, tol=1e-4, maxiter=self.N)
-                D = np.real(D)
-                V = np.real(V)
-                inds = np.argsort(D)[::-1]
-                D = D[inds]
-                V = V[:, inds]
-                # Normalize by the first diffusion component
-                for i in range(V.shape[1]):
-                    V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
+                D, V = self._eigs(target)
                 vals = np.array(V)
                 residual = np.sum(vals < 0, axis=0)
                 target = target * 2
@@ -282,18 +376,7 @@ class Diffusor(TransformerMixin):
         if len(residual) > 30:
             self.n_components = len(pos) + 15
             # adapted eigen value decomposition
-            if self.transitions:
-               D, V = eigs(self.T, self.n_components, tol=1e-4, maxiter=self.N)
-            else:
-                D, V = eigs(self.K, self.n_components, tol=1e-4, maxiter=self.N)
-            D = np.real(D)
-            V = np.real(V)
-            inds = np.argsort(D)[::-1]
-            D = D[inds]
-            V = V[:, inds]
-            # Normalize by the first diffusion component
-            for i in range(V.shape[1]):
-                V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
+            D, V = self._eigs(self.n_components)
 
 
 
@@ -329,18 +412,7 @@ class Diffusor(TransformerMixin):
             # Use user's  or default initial guess
             multiplier = self.N // 10e4
             # initial eigen value decomposition
-            if self.transitions:
-                D, V = eigs(self.T, self.n_components, tol=1e-4, maxiter=self.N)
-            else:
-                D, V = eigs(self.K, self.n_components, tol=1e-4, maxiter=self.N)
-            D = np.real(D)
-            V = np.real(V)
-            inds = np.argsort(D)[::-1]
-            D = D[inds]
-            V = V[:, inds]
-            # Normalize by the first diffusion component
-            for i in range(V.shape[1]):
-                V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
+            D, V = self._eigs(self.n_components)
             vals = np.array(V)
             pos = np.sum(vals > 0, axis=0)
             residual = np.sum(vals < 0, axis=0)
@@ -351,18 +423,7 @@ class Diffusor(TransformerMixin):
                 while residual < 3:
                     print('Eigengap not found for determined number of components. Expanding eigendecomposition to '
                           + str(target) + 'components.')
-                    if self.transitions:
-                        D, V = eigs(self.T, target, tol=1e-4, maxiter=self.N)
-                    else:
-                        D, V = eigs(self.K, target, tol=1e-4, maxiter=self.N)
-                    D = np.real(D)
-                    V = np.real(V)
-                    inds = np.argsort(D)[::-1]
-                    D = D[inds]
-                    V = V[:, inds]
-                    # Normalize by the first diffusion component
-                    for i in range(V.shape[1]):
-                        V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
+                    D, V = self._eigs(target)
                     vals = np.array(V)
                     residual = np.sum(vals < 0, axis=0)
                     target = target * 2
@@ -370,18 +431,7 @@ class Diffusor(TransformerMixin):
             if len(residual) > 30:
                 self.n_components = len(pos) + 15
                 # adapted eigen value decomposition
-                if self.transitions:
-                    D, V = eigs(self.T, self.n_components, tol=1e-4, maxiter=self.N)
-                else:
-                    D, V = eigs(self.K, self.n_components, tol=1e-4, maxiter=self.N)
-                D = np.real(D)
-                V = np.real(V)
-                inds = np.argsort(D)[::-1]
-                D = D[inds]
-                V = V[:, inds]
-                # Normalize by the first diffusion component
-                for i in range(V.shape[1]):
-                    V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
+                D, V = self._eigs(self.n_components)
 
 
         # Create the results dictionary
@@ -11,10 +11,9 @@ def multiscale(res, n_eigs=None):
         vals = np.array(res["EigenValues"])
         n_eigs = np.sum( vals > 0, axis=0)
     # Multiscale diffusion
-    use_eigs = list(range(0, n_eigs))
-    ev = res['EigenValues']
-    eig_vals = np.ravel(ev.reindex(use_eigs))
-    ms_data = res["EigenVectors"].values[:, use_eigs] * (eig_vals / (1 - eig_vals))
+    # Components are sorted by eigenvalue, so the leading ones are taken with plain slices
+    eig_vals = np.asarray(res['EigenValues'])[:n_eigs]
+    ms_data = res["EigenVectors"].values[:, :n_eigs] * (eig_vals / (1 - eig_vals))
     ms_data = pd.DataFrame(ms_data, index=res["EigenVectors"].index)
     print('Automatically selected and multiscaled ' + str(round(n_eigs)) +
           ' diffusion components.')